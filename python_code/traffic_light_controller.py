@@ -5,20 +5,54 @@ Author: Your Name
 Description: YOLOv5-based car detection with Arduino traffic light control
 """
 import torch
+import torchvision
 import cv2
+import numpy as np
 import serial
 import time
 import logging
+import math
 import os
-from datetime import datetime
+import sys
+import select
+import queue
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
 from typing import Optional
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional - fall back to plain Python
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
 # === [CONFIG] ===
 SOURCE = 1 # Change to your camera index
 COM_PORT = 'COM4'   #Change to your Arduino port
 BAUD_RATE = 9600
 CONFIDENCE_THRESHOLD = 0.70  # Minimum confidence for detections
 MODEL_PATH = 'models/best.pt'  # Put your trained model here
+CAR_CLASS_NAME = 'car'  # Class counted as a car (looked up in the model's class names)
+DETECT_ONLY_CARS = True  # Drop every other class before NMS (a single-class model trained on 'car' is faster still)
+EXPORT_MODEL = True  # Export MODEL_PATH once to TensorRT (GPU) / ONNX (CPU) and load that instead
+ENGINE_PATH = None  # Exported model location, None = next to MODEL_PATH (models/best.engine or .onnx)
+# TensorRT engines to run in parallel instead of the main model, e.g. one per Jetson DLA core
+# built with trtexec --useDLACore=0/1 --allowGPUFallback. Frames are dispatched round-robin.
+DLA_ENGINE_PATHS = []
+PRECISION = 'fp16'  # 'fp16' or 'int8' (INT8 = OpenVINO export calibrated on frames from SOURCE)
+CALIBRATION_FRAMES = 500  # Frames captured from SOURCE for INT8 calibration
+CALIBRATION_PATH = 'calibration'  # Folder for calibration images and calib.yaml
+INFER_SIZE = 384  # YOLO input size (multiple of 32) - frames are downscaled to this before inference
+GPU_PREPROCESS = True  # CUDA: upload raw uint8 frames and resize/pad/normalize them on the GPU
+CAMERA_WIDTH = 640  # Requested camera resolution
+CAMERA_HEIGHT = 480
+CAMERA_FPS = 30
+CAMERA_FOURCC = 'MJPG'  # Compressed USB stream - avoids the YUY2 bandwidth limit on USB2 webcams
+USE_GSTREAMER = True  # Decode H.264 file/RTSP sources on the GPU (Jetson NVDEC) when OpenCV has GStreamer
 
 # Traffic light timing
 YELLOW_DURATION = 2  # Yellow light duration in seconds
@@ -29,25 +63,234 @@ LOW_TRAFFIC_THRESHOLD = 6  # Car count threshold to return to normal
 # Detection confirmation settings
 DETECTION_CONFIRMATION_TIME = 3  # Seconds to confirm car detection before changing light
 DETECTION_HISTORY_SIZE = 10  # Number of frames to average for stable detection
+HIGH_TRAFFIC_CONFIRMATION_TIME = 1.5  # Faster confirmation for high traffic (urgent)
 
 # Training data collection
 ENABLE_TRAINING_DATA = False  # Set to True to enable automatic dataset collection
 # Use absolute path - Update this to your yolov5 folder location!
 DATASET_SAVE_PATH = 'dataset'  # Training data collection folder
+SAVE_QUEUE_SIZE = 8  # Frames waiting to be encoded and written before new ones are dropped
+JPEG_QUALITY = 85  # JPEG quality for saved training images
+
+# Display
+HEADLESS = None  # True = no window (keys from console), False = always show window, None = auto-detect
+KEY_WAIT_INTERVAL = 4  # Windows only: full waitKey every Nth frame, non-blocking pollKey in between
+
+# Pipeline settings
+PIPELINE_QUEUE_SIZE = 2  # Max results buffered between inference and display (capture -> inference holds 1)
+SKIP_FRAMES = 2  # Run YOLO on every Nth frame, reuse previous detections in between
+MAX_SKIP_FRAMES = 6  # Upper limit when adapting SKIP_FRAMES to a slow machine (YOLO slower than the camera)
+SERIAL_QUEUE_SIZE = 4  # Pending Arduino commands before the oldest is dropped
+MOTION_GATE = True  # Skip YOLO while nothing moves in the scene (detections are reused)
+MOTION_THRESHOLD = 0.002  # Fraction of moving pixels (in a 160x90 thumbnail) that counts as motion
+MOTION_MAX_SKIP = 15  # Run YOLO at least every Nth frame even without motion
+
+# CPU threading
+OPENCV_THREADS = 2  # OpenCV worker threads (only small resizes/draws here), None = OpenCV default
+TORCH_THREADS = None  # PyTorch CPU threads, None = default (e.g. 2 on a GPU box like Jetson)
+CPU_AFFINITY = None  # Linux only: CPU cores to run on, e.g. {4, 5} for the big cores on Jetson
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Traffic light state machine key and car count buckets
+LightState = namedtuple('LightState', 'a b mode ytrans')
+# Light/mode/timer state copied for the display thread so it never reads half-updated fields
+HudState = namedtuple('HudState', 'light_a light_b is_yellow_transition yellow_start_time is_high_traffic_mode '
+                                  'high_traffic_start_time high_traffic_direction last_state_change_time fps')
+COUNT_NONE, COUNT_LOW, COUNT_HIGH = 0, 1, 2
+
+def count_bucket(car_count):
+    """Bucket car count into 0 / 1-7 / >=8 for the transition table"""
+    if car_count == 0:
+        return COUNT_NONE
+    if car_count >= HIGH_TRAFFIC_THRESHOLD:
+        return COUNT_HIGH
+    return COUNT_LOW
+
+# Detection confirmation events returned by decide_confirmed_count
+CONFIRM_IDLE, CONFIRM_NEW, CONFIRM_WAIT, CONFIRM_DONE = 0, 1, 2, 3
+
+@njit(cache=True)
+def decide_confirmed_count(history_sum, history_len, confirmed, pending, last_change, now,
+                           confirmation_time, high_threshold):
+    """
+    Numeric core of get_confirmed_car_count.
+    Returns (confirmed, pending, last_change, time_elapsed, event).
+    """
+    # Average of recent detections, rounded to nearest integer (half to even, like round())
+    smoothed_count = int(np.rint(history_sum / history_len))
+    time_elapsed = 0.0
+    event = CONFIRM_IDLE
+    
+    # Check if we need to change state
+    # High traffic is always treated as a change so it gets confirmed quickly
+    if smoothed_count >= high_threshold or smoothed_count != confirmed:
+        new_state = smoothed_count
+        # Check if this is a new pending change
+        if new_state != pending:
+            # New change detected, start confirmation timer
+            pending = new_state
+            last_change = now
+            event = CONFIRM_NEW
+        else:
+            # Still the same pending change, check if enough time has passed
+            time_elapsed = now - last_change
+            
+            # Reduce confirmation time for high traffic (urgent)
+            required_time = confirmation_time
+            if new_state >= high_threshold:
+                required_time = HIGH_TRAFFIC_CONFIRMATION_TIME
+            
+            event = CONFIRM_WAIT
+            if time_elapsed >= required_time:
+                # Confirmed! Update the official count and reset pending
+                confirmed = new_state
+                pending = confirmed
+                event = CONFIRM_DONE
+    else:
+        # State hasn't changed, maintain current confirmed count
+        pending = confirmed
+    
+    return confirmed, pending, last_change, time_elapsed, event
+
+class CameraThread(threading.Thread):
+    """Background camera grabber - hands out the newest frame of a live source, every frame of a video file"""
+    def __init__(self, source, backend=cv2.CAP_ANY, live=None):
+        super().__init__(name="camera", daemon=True)
+        self.cap = cv2.VideoCapture(source, backend)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Keep the driver-side queue short
+        # Files are read in order (grabbing freely would race through them), cameras/streams free-run
+        self.live = not (isinstance(source, str) and os.path.isfile(source)) if live is None else live
+        self.nominal_fps = 0 if self.live else self.cap.get(cv2.CAP_PROP_FPS)  # Recorded frame rate of a file
+        self.lock = threading.Lock()
+        self.new_frame = threading.Condition(self.lock)
+        self.running = False
+        self.grabbed = True
+        self.frame_id = 0  # Frames grabbed so far
+        self.read_id = 0  # frame_id of the last frame handed out by read()
+        self.retrieve_requested = False  # A reader is waiting - decode the next grabbed frame
+        self.frame = None
+        self.frame_ok = False
+        self.frame_ready_id = 0  # frame_id of self.frame
+        self.latest_ts = None
+    
+    def isOpened(self):
+        return self.cap.isOpened()
+    
+    def set(self, prop, value):
+        return self.cap.set(prop, value)
+    
+    def start(self):
+        self.running = True
+        super().start()
+    
+    def run(self):
+        """Keep grabbing so the driver buffer never holds stale frames (files: one frame per read)"""
+        while self.running:
+            if not self.live:
+                # Wait until the previous frame was read so no frame of the file is skipped
+                with self.lock:
+                    while self.running and self.frame_ready_id != self.read_id:
+                        self.new_frame.wait(timeout=1)
+            
+            # grab() blocks until the next frame arrives, so it runs outside the lock
+            grabbed = self.cap.grab()
+            with self.lock:
+                self.grabbed = grabbed
+                if grabbed:
+                    self.frame_id += 1
+                    self.latest_ts = time.monotonic()
+                    if self.retrieve_requested or not self.live:
+                        # Only decode frames somebody is waiting for
+                        self.retrieve_requested = False
+                        self.frame_ok, self.frame = self.cap.retrieve()
+                        self.frame_ready_id = self.frame_id
+                self.new_frame.notify_all()
+            if not grabbed:
+                break
+    
+    def read(self):
+        """Get the next frame decoded after this call (waits for the grabber)"""
+        with self.lock:
+            while self.running and self.grabbed and self.frame_ready_id == self.read_id:
+                self.retrieve_requested = True
+                self.new_frame.wait(timeout=1)
+            if self.frame_ready_id == self.read_id:
+                return False, None
+            self.read_id = self.frame_ready_id
+            frame, self.frame = self.frame, None
+            self.new_frame.notify_all()  # File sources: let the grabber fetch the next frame
+            return self.frame_ok, frame
+    
+    def release(self):
+        self.running = False
+        if self.is_alive():
+            self.join(timeout=2)
+        self.cap.release()
+
+class AsyncPredictor:
+    """Runs detection on several engines at once (e.g. Jetson DLA cores), one worker thread per engine"""
+    def __init__(self, models, detect):
+        self.models = models
+        self.detect = detect  # detect(model, frame) -> result
+        self.size = len(models)
+        self.next_model = 0
+        # One single-worker executor per engine - an engine's context and bindings are not thread-safe,
+        # so a frame sent to a busy engine waits for it instead of running alongside
+        self.executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"predictor{i}")
+                          for i in range(self.size)]
+    
+    def submit(self, frame):
+        """Queue frame on the next engine (round-robin), returns a Future"""
+        index = self.next_model
+        self.next_model = (self.next_model + 1) % self.size
+        return self.executors[index].submit(self.detect, self.models[index], frame)
+    
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=True, cancel_futures=True)
+
 class DualTrafficLightAI:
     def __init__(self, model_path: str, com_port: str, baud_rate: int = 9600):
         self.model_path = model_path
         self.com_port = com_port
         self.baud_rate = baud_rate
         self.model = None
+        self.device = 'cpu'
+        self.use_half = False  # FP16 inference, enabled automatically on CUDA
+        self.car_class_id = 0  # Resolved from the model's class names in load_model
+        self.predictor = None  # AsyncPredictor when DLA_ENGINE_PATHS is set
+        self.host_buf = None  # Pinned host tensor for the YOLO input (CUDA only)
+        self.cuda_stream = None
+        self.letterbox_buf = None
+        self.infer_bufs = threading.local()  # Reused downscale buffer for the AutoShape path
+        self.letterbox_shape = None
+        self.frame_host_buf = None  # Pinned uint8 frame for GPU preprocessing (CUDA only)
+        self.gpu_input = None
         self.arduino = None
+        self.serial_q = queue.Queue(maxsize=SERIAL_QUEUE_SIZE)
+        self.serial_thread = None
+        self.last_sent_bytes = None  # Last light command queued for the Arduino
         self.cap = None
         
+        # Capture -> inference -> display pipeline
+        self.frame_q = queue.Queue(maxsize=1)  # Single slot - inference always picks up the newest frame
+        self.result_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.display_q = queue.Queue(maxsize=1)  # Single slot - the window only shows the newest frame
+        self.stop_event = threading.Event()
+        self.quit_event = threading.Event()  # Set by key handling ('q')
+        self.reset_event = threading.Event()  # Set by key handling ('r')
+        self.threads = []
+        
+        # Frame skipping - detections are reused between YOLO runs
+        self.skip_frames = SKIP_FRAMES
+        self.frame_idx = 0
+        self.frames_since_detection = 0
+        self.last_detections = None
+        self.bg_subtractor = cv2.createBackgroundSubtractorMOG2(history=200, varThreshold=25, detectShadows=False)
+        
         # Traffic light states
         self.light_a = 'R'  # AI-controlled light (starts Red - no cars)
         self.light_b = 'G'  # Opposite light (starts Green - cross traffic)
@@ -59,14 +302,37 @@ class DualTrafficLightAI:
         self.is_high_traffic_mode = False
         self.high_traffic_direction = 'B'  # Track which direction has green in high traffic mode
         self.last_command_time = 0
+        self.frame_time = 0  # Timestamp shared by everything handling the current frame
         
         # FPS calculation
         self.fps_counter = 0
-        self.fps_start_time = time.time()
+        self.fps_start_time = time.monotonic()
         self.current_fps = 0
+        self.camera_fps = 0  # Frames grabbed by the camera per second
+        self.last_grab_count = 0
+        self.infer_time = None  # Smoothed seconds per YOLO run (set by the inference thread)
+        
+        # Display - auto-detect if a screen is available (Linux without X11/Wayland = headless)
+        if HEADLESS is None:
+            self.headless = (sys.platform.startswith('linux')
+                             and not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'))
+        else:
+            self.headless = HEADLESS
+        self.console_keys = True  # Poll the console for 'q' / 'r' when headless
+        self.key_poll_counter = 0
+        
+        # Cached UI elements (static overlay is built on the first frame)
+        self.static_shape = None
+        self.static_mask = None
+        self.static_pixels = None
+        self.static_alpha = None
+        self.light_patches = {}
+        self.text_masks = {}  # Pre-rendered labels that only take a few values (light states, modes)
         
         # Training data collection
         self.last_save_time = 0
+        self.save_q = queue.Queue(maxsize=SAVE_QUEUE_SIZE)
+        self.save_thread = None
         if ENABLE_TRAINING_DATA:
             # Use custom path or default
             self.dataset_path = os.path.abspath(DATASET_SAVE_PATH)
@@ -78,6 +344,9 @@ class DualTrafficLightAI:
             logger.info(f"  - Cars: {self.dataset_path}/cars/")
             logger.info(f"  - Empty: {self.dataset_path}/empty/")
             logger.info("=" * 60)
+            # Disk writes happen on a background thread to keep the vision loop fast
+            self.save_thread = threading.Thread(target=self.save_writer_loop, name="saver", daemon=True)
+            self.save_thread.start()
             # Open folder in file explorer (Windows only)
             try:
                 import subprocess
@@ -87,177 +356,440 @@ class DualTrafficLightAI:
                 pass
         
         # Detection confirmation system
-        self.detection_history = []  # Store recent car counts
+        self.history_arr = np.zeros(DETECTION_HISTORY_SIZE, dtype=np.int32)  # Ring buffer of recent car counts
+        self.history_len = 0  # Number of valid entries in history_arr
+        self.history_pos = 0  # Next slot to write in history_arr
+        self.history_sum = 0  # Running sum of history_arr
         self.confirmed_car_count = 0  # Stable car count after confirmation
-        self.last_state_change_time = time.time()  # Track when we last confirmed a state change
+        self.last_state_change_time = time.monotonic()  # Track when we last confirmed a state change
         self.pending_car_count = 0  # Count we're trying to confirm
         
+        # Cached so per-frame debug logging costs nothing at the default INFO level
+        self.debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        
     def load_model(self):
         """Load YOLOv5 model"""
         try:
-            self.model = torch.hub.load('ultralytics/yolov5', 'custom', path=self.model_path)
+            weights = self.get_inference_weights()
+            self.model = torch.hub.load('ultralytics/yolov5', 'custom', path=weights)
             self.model.conf = CONFIDENCE_THRESHOLD
+            self.check_input_size(self.model, weights)
+            
+            # Look up the car class once so counting only compares class ids
+            class_ids = {name: class_id for class_id, name in self.load_class_names(weights).items()}
+            if CAR_CLASS_NAME in class_ids:
+                self.car_class_id = class_ids[CAR_CLASS_NAME]
+            else:
+                logger.warning(f"Class '{CAR_CLASS_NAME}' not in model classes {list(class_ids)}, counting class 0")
+            self.model.classes = [self.car_class_id] if DETECT_ONLY_CARS else None
             
             # Customize label appearance - smaller text and thinner boxes
             self.model.amp = False  # Disable automatic mixed precision for consistency
             
-            logger.info("YOLOv5 model loaded successfully")
+            # Run in half precision on GPU - AutoShape casts input frames to the model dtype
+            # (an INT8 OpenVINO export runs on the CPU - decided by what was loaded, since a failed
+            # INT8 export falls back to the .pt model, which should still use the GPU)
+            openvino = bool(getattr(getattr(self.model, 'model', None), 'xml', False)
+                            or str(weights).rstrip('/\\').endswith('_openvino_model'))
+            if PRECISION == 'int8' and not openvino:
+                logger.warning(f"INT8 model not available, running {weights} in "
+                               f"{'FP16 on the GPU' if torch.cuda.is_available() else 'FP32 on the CPU'} instead")
+            if torch.cuda.is_available() and not openvino:
+                self.device = 'cuda'
+                self.model.to(self.device).half()
+                self.use_half = True
+                
+                # Persistent pinned input buffer + side stream for async host-to-device copies
+                self.host_buf = torch.empty((1, 3, INFER_SIZE, INFER_SIZE), dtype=torch.float16, pin_memory=True)
+                self.cuda_stream = torch.cuda.Stream()
+                self.letterbox_buf = np.full((INFER_SIZE, INFER_SIZE, 3), 114, np.uint8)
+            
+            if DLA_ENGINE_PATHS:
+                engines = []
+                for path in DLA_ENGINE_PATHS:
+                    engine = torch.hub.load('ultralytics/yolov5', 'custom', path=path)
+                    engine.conf = CONFIDENCE_THRESHOLD
+                    self.check_input_size(engine, path)
+                    engine.classes = self.model.classes
+                    engines.append(engine)
+                self.predictor = AsyncPredictor(engines, self.detect_autoshape_timed)
+                logger.info(f"Dispatching inference across {len(engines)} engines: {DLA_ENGINE_PATHS}")
+            
+            logger.info(f"YOLOv5 model loaded successfully ({weights}, {self.device}, {'FP16' if self.use_half else 'FP32'})")
         except Exception as e:
             logger.error(f"Failed to load model: {e}")
             raise
     
+    def load_class_names(self, weights):
+        """Class names as {id: name} - TensorRT engines don't store them, so prefer the .pt checkpoint's"""
+        names = self.model.names
+        if weights != self.model_path and os.path.exists(self.model_path):
+            repo = os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master')
+            sys.path.insert(0, repo)  # The checkpoint pickles YOLOv5's model classes
+            try:
+                ckpt = torch.load(self.model_path, map_location='cpu', weights_only=False)
+                names = (ckpt.get('ema') or ckpt['model']).names
+            except Exception as e:
+                logger.warning(f"Could not read class names from {self.model_path}: {e}")
+            finally:
+                sys.path.remove(repo)
+        return dict(names) if isinstance(names, dict) else dict(enumerate(names))
+    
+    def check_input_size(self, model, weights):
+        """Refuse to start if a static TensorRT/ONNX export was made for a different input size than INFER_SIZE"""
+        backend = getattr(model, 'model', None)
+        if getattr(backend, 'engine', False):
+            shape = tuple(backend.bindings['images'].shape)
+        elif getattr(backend, 'onnx', False):
+            shape = tuple(backend.session.get_inputs()[0].shape)
+        else:
+            return
+        if all(isinstance(dim, int) for dim in shape[-2:]) and shape[-2:] != (INFER_SIZE, INFER_SIZE):
+            raise ValueError(f"{weights} was exported for {shape[-1]}x{shape[-2]} input but INFER_SIZE is {INFER_SIZE}, "
+                             f"delete it to re-export or set INFER_SIZE to match")
+    
+    def get_inference_weights(self):
+        """Get the exported TensorRT/ONNX model, exporting it on first run (falls back to the .pt model)"""
+        if not EXPORT_MODEL:
+            return self.model_path
+        
+        stem = os.path.splitext(self.model_path)[0]
+        if PRECISION == 'int8':
+            # YOLOv5's exporter only calibrates INT8 for OpenVINO
+            fmt, export_args = 'openvino', ['--int8']
+            export_path = f"{stem}_int8_openvino_model"
+        elif torch.cuda.is_available():
+            # TensorRT engines need a GPU
+            fmt, export_args = 'engine', ['--half', '--device', '0', '--workspace', '4']
+            export_path = f"{stem}.engine"
+        else:
+            # ONNX Runtime is the fast path on CPU
+            fmt, export_args = 'onnx', ['--simplify']
+            export_path = f"{stem}.onnx"
+        engine_path = ENGINE_PATH or export_path
+        if os.path.exists(engine_path):
+            return engine_path
+        
+        logger.info(f"Exporting {self.model_path} to {fmt} (first run only, this can take a few minutes)...")
+        try:
+            import subprocess
+            if PRECISION == 'int8':
+                export_args += ['--data', self.prepare_calibration_data()]
+            torch.hub.list('ultralytics/yolov5')  # Make sure the YOLOv5 repo (and export.py) is cached
+            export_script = os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master', 'export.py')
+            # Static shape (no --dynamic, batch 1) so TensorRT/ONNX Runtime can specialize every kernel
+            cmd = [sys.executable, export_script, '--weights', self.model_path, '--include', fmt,
+                   '--imgsz', str(INFER_SIZE), '--batch-size', '1'] + export_args
+            subprocess.run(cmd, check=True)
+            
+            # export.py logs a failed export (e.g. TensorRT not installed) but still exits 0
+            if not os.path.exists(export_path):
+                logger.warning(f"Model export produced no {export_path}, using PyTorch model instead "
+                               f"(set EXPORT_MODEL = False to skip the export attempt)")
+                return self.model_path
+            
+            # export.py writes next to the weights, move it if a custom ENGINE_PATH is set
+            if engine_path != export_path:
+                os.replace(export_path, engine_path)
+            logger.info(f"Exported model saved to {engine_path}")
+            return engine_path
+        except Exception as e:
+            logger.warning(f"Model export failed, using PyTorch model instead: {e}")
+            return self.model_path
+    
+    def prepare_calibration_data(self):
+        """
+        Capture CALIBRATION_FRAMES representative frames from SOURCE for INT8 calibration.
+        Returns the path of a YOLOv5 data yaml pointing at them.
+        """
+        calib_dir = os.path.abspath(CALIBRATION_PATH)
+        image_dir = os.path.join(calib_dir, 'images')
+        yaml_path = os.path.join(calib_dir, 'calib.yaml')
+        if os.path.exists(yaml_path):
+            return yaml_path
+        
+        os.makedirs(image_dir, exist_ok=True)
+        cap = cv2.VideoCapture(SOURCE)
+        if not cap.isOpened():
+            raise Exception(f"Cannot open camera source for calibration: {SOURCE}")
+        logger.info(f"Capturing {CALIBRATION_FRAMES} calibration frames from {SOURCE}...")
+        saved = 0
+        try:
+            while saved < CALIBRATION_FRAMES:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                cv2.imwrite(os.path.join(image_dir, f"calib_{saved:04d}.jpg"), frame)
+                saved += 1
+        finally:
+            cap.release()
+        if saved == 0:
+            raise Exception("No calibration frames captured")
+        
+        # Only the images are used for calibration, labels/names just need to be valid
+        with open(yaml_path, 'w') as f:
+            f.write(f"path: {calib_dir}\ntrain: images\nval: images\nnames: ['car']\n")
+        logger.info(f"Saved {saved} calibration frames to {image_dir}")
+        return yaml_path
+    
     def setup_arduino(self):
         """Connect to Arduino"""
         try:
-            self.arduino = serial.Serial(self.com_port, self.baud_rate, timeout=1)
+            # Writes happen on a background thread, so they may block briefly - a finite write_timeout
+            # makes write() send the whole command or raise (write_timeout=0 silently drops the rest)
+            self.arduino = serial.Serial(self.com_port, self.baud_rate, timeout=0, write_timeout=0.5)
+            try:
+                self.arduino.set_low_latency_mode(True)
+            except (AttributeError, NotImplementedError, ValueError, OSError):
+                pass  # Only supported by some drivers (Linux, pyserial >= 3.5)
             time.sleep(2)  # Wait for connection
             logger.info(f"Connected to Arduino on {self.com_port}")
         except Exception as e:
             logger.error(f"Could not connect to Arduino: {e}")
             raise
+        
+        self.serial_thread = threading.Thread(target=self.serial_writer_loop, name="serial", daemon=True)
+        self.serial_thread.start()
+    
+    def serial_writer_loop(self):
+        """Write queued commands to the Arduino so the vision loop never blocks on the UART"""
+        running = True
+        while running:
+            batch = [self.serial_q.get()]
+            # Coalesce everything queued meanwhile (e.g. several state changes in one frame) into one write
+            while True:
+                try:
+                    batch.append(self.serial_q.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = batch[:batch.index(None)]
+            if not batch:
+                continue
+            try:
+                self.arduino.write(b"".join(batch))
+            except Exception as e:
+                logger.error(f"Failed to send command: {e}")
+    
+    def queue_serial(self, data):
+        """Queue raw bytes for the serial writer thread, dropping the oldest if it falls behind"""
+        try:
+            self.serial_q.put_nowait(data)
+        except queue.Full:
+            try:
+                self.serial_q.get_nowait()
+            except queue.Empty:
+                pass
+            self.serial_q.put_nowait(data)
+    
+    def stop_serial_writer(self):
+        """Let the serial writer flush pending commands and exit"""
+        if self.serial_thread:
+            try:
+                self.serial_q.put(None, timeout=1)
+            except queue.Full:
+                pass
+            self.serial_thread.join(timeout=2)
+            self.serial_thread = None
     
     def setup_camera(self, source):
         """Open webcam"""
-        self.cap = cv2.VideoCapture(source)
+        # Pick the native backend for webcams (DirectShow avoids MSMF's extra buffering on Windows)
+        backend = cv2.CAP_ANY
+        if isinstance(source, int):
+            if sys.platform == 'win32':
+                backend = cv2.CAP_DSHOW
+            elif sys.platform.startswith('linux'):
+                backend = cv2.CAP_V4L2
+        elif (USE_GSTREAMER and (source.startswith('rtsp://') or os.path.isfile(source))
+              and self.gstreamer_available()):
+            # H.264 video file / RTSP stream - try hardware decoding first
+            self.cap = CameraThread(self.gstreamer_pipeline(source), cv2.CAP_GSTREAMER,
+                                    live=not os.path.isfile(source))
+            if self.cap.isOpened():
+                self.cap.start()
+                logger.info("Camera opened with GStreamer hardware decoding")
+                return
+            logger.warning("GStreamer pipeline failed to open, falling back to software decoding")
+            self.cap.release()
+        
+        self.cap = CameraThread(source, backend)
         if not self.cap.isOpened():
             raise Exception(f"Cannot open camera source: {source}")
+        # FOURCC has to be set before the resolution for most drivers
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*CAMERA_FOURCC))
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_WIDTH)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_HEIGHT)
+        self.cap.set(cv2.CAP_PROP_FPS, CAMERA_FPS)
+        self.cap.start()
         logger.info(f"Camera opened successfully")
     
+    def gstreamer_available(self):
+        """Check if this OpenCV build includes the GStreamer backend"""
+        for line in cv2.getBuildInformation().splitlines():
+            if 'GStreamer:' in line:
+                return 'YES' in line
+        return False
+    
+    def gstreamer_pipeline(self, source):
+        """GStreamer pipeline that decodes an H.264 file or RTSP stream with NVDEC into BGR frames"""
+        if source.startswith('rtsp://'):
+            # Live stream - only keep the newest frame
+            src = f"rtspsrc location={source} latency=0 ! rtph264depay"
+            sink = "appsink drop=1 max-buffers=1 sync=false"
+        else:
+            # File - play at its own rate and never drop frames
+            src = f"filesrc location={source} ! qtdemux"
+            sink = "appsink sync=true"
+        return (f"{src} ! h264parse ! nvv4l2decoder ! nvvidconv ! video/x-raw,format=BGRx ! "
+                f"videoconvert ! video/x-raw,format=BGR ! {sink}")
+    
     def count_cars(self, detections):
-        """Count cars from YOLO detections"""
-        car_count = sum(1 for det in detections if int(det[-1]) == 0)
-        return car_count
+        """Count cars from YOLO detections (N x 6 tensor or array, class in last column)"""
+        return int((detections[:, -1] == self.car_class_id).sum().item())
     
-    def get_confirmed_car_count(self, current_count):
+    def get_confirmed_car_count(self, current_count, current_time):
         """
         Get confirmed car count with temporal smoothing to avoid false detections.
         Only updates the confirmed count if the detection is stable for DETECTION_CONFIRMATION_TIME seconds.
         """
-        current_time = time.time()
-        
-        # Add current count to history
-        self.detection_history.append(current_count)
-        
-        # Keep only recent history
-        if len(self.detection_history) > DETECTION_HISTORY_SIZE:
-            self.detection_history.pop(0)
-        
-        # Calculate average of recent detections
-        avg_count = sum(self.detection_history) / len(self.detection_history)
-        # Round to nearest integer for car count
-        smoothed_count = round(avg_count)
-        
-        # Check if we need to change state
-        # For high traffic threshold, be more responsive
-        if smoothed_count >= HIGH_TRAFFIC_THRESHOLD:
-            # High traffic detected - confirm faster or immediately
-            state_changed = True
-            new_state = smoothed_count
-        elif self.confirmed_car_count == 0 and smoothed_count >= 1:
-            # Trying to transition from 0 cars to 1+ cars
-            state_changed = True
-            new_state = smoothed_count
-        elif self.confirmed_car_count >= 1 and smoothed_count == 0:
-            # Trying to transition from 1+ cars to 0 cars
-            state_changed = True
-            new_state = 0
-        elif abs(smoothed_count - self.confirmed_car_count) > 0:
-            # Car count changed but not crossing 0 boundary
-            state_changed = True
-            new_state = smoothed_count
+        # Add current count to the ring buffer, keeping a running sum
+        if self.history_len == DETECTION_HISTORY_SIZE:
+            self.history_sum -= int(self.history_arr[self.history_pos])
         else:
-            state_changed = False
-            new_state = self.confirmed_car_count
-        
-        # If state is trying to change
-        if state_changed:
-            # Check if this is a new pending change
-            if new_state != self.pending_car_count:
-                # New change detected, start confirmation timer
-                self.pending_car_count = new_state
-                self.last_state_change_time = current_time
-                logger.debug(f"New detection pending: {new_state} cars (waiting {DETECTION_CONFIRMATION_TIME}s)")
-            else:
-                # Still the same pending change, check if enough time has passed
-                time_elapsed = current_time - self.last_state_change_time
-                
-                # Reduce confirmation time for high traffic (urgent)
-                required_time = DETECTION_CONFIRMATION_TIME
-                if new_state >= HIGH_TRAFFIC_THRESHOLD:
-                    required_time = 1.5  # Only 1.5 seconds for high traffic (faster response)
-                    logger.debug(f"High traffic pending: {new_state} cars (waiting {required_time}s)")
-                
-                if time_elapsed >= required_time:
-                    # Confirmed! Update the official count
-                    self.confirmed_car_count = new_state
-                    logger.info(f"Detection CONFIRMED: {self.confirmed_car_count} cars (stable for {time_elapsed:.1f}s)")
-                    # Reset pending
-                    self.pending_car_count = self.confirmed_car_count
-        else:
-            # State hasn't changed, maintain current confirmed count
-            self.pending_car_count = self.confirmed_car_count
+            self.history_len += 1
+        self.history_arr[self.history_pos] = current_count
+        self.history_sum += current_count
+        self.history_pos = (self.history_pos + 1) % DETECTION_HISTORY_SIZE
+        
+        # Numeric decision runs compiled, logging stays in Python
+        confirmed, pending, last_change, time_elapsed, event = decide_confirmed_count(
+            self.history_sum, self.history_len, self.confirmed_car_count, self.pending_car_count,
+            self.last_state_change_time, current_time, DETECTION_CONFIRMATION_TIME, HIGH_TRAFFIC_THRESHOLD)
+        self.confirmed_car_count = confirmed
+        self.pending_car_count = pending
+        self.last_state_change_time = last_change
+        
+        if event == CONFIRM_NEW:
+            if self.debug_enabled:
+                logger.debug("New detection pending: %d cars (waiting %ss)", pending, DETECTION_CONFIRMATION_TIME)
+        elif event != CONFIRM_IDLE:
+            if self.debug_enabled and pending >= HIGH_TRAFFIC_THRESHOLD:
+                logger.debug("High traffic pending: %d cars (waiting %ss)", pending, HIGH_TRAFFIC_CONFIRMATION_TIME)
+            if event == CONFIRM_DONE:
+                logger.info("Detection CONFIRMED: %d cars (stable for %.1fs)", confirmed, time_elapsed)
         
         return self.confirmed_car_count
     
-    def calculate_fps(self):
+    def calculate_fps(self, current_time):
         """Calculate current FPS"""
         self.fps_counter += 1
-        current_time = time.time()
         
         if current_time - self.fps_start_time >= 1.0:  # Update every second
             self.current_fps = self.fps_counter
+            grabs = self.cap.frame_id if self.cap else 0
+            if self.cap and self.cap.nominal_fps:
+                # Video file - read at our own pace, so keep up with its recorded rate
+                self.camera_fps = self.cap.nominal_fps
+            else:
+                self.camera_fps = (grabs - self.last_grab_count) / (current_time - self.fps_start_time)
+            self.last_grab_count = grabs
             self.fps_counter = 0
             self.fps_start_time = current_time
+            self.adapt_skip_frames()
     
-    def save_training_frame(self, frame, car_count):
+    def adapt_skip_frames(self):
+        """Tune how often YOLO runs based on inference time vs camera rate and traffic level"""
+        if self.confirmed_car_count >= HIGH_TRAFFIC_THRESHOLD - 1:
+            # Close to high traffic - run detection on every frame for responsiveness
+            self.skip_frames = 1
+        elif self.infer_time is None or not self.camera_fps:
+            self.skip_frames = SKIP_FRAMES
+        else:
+            # Smallest stride at which YOLO keeps up with the camera (a slow camera never raises it)
+            engines = self.predictor.size if self.predictor else 1
+            needed = math.ceil(self.infer_time * self.camera_fps / engines)
+            self.skip_frames = min(max(needed, SKIP_FRAMES), MAX_SKIP_FRAMES)
+    
+    def save_training_frame(self, frame, car_count, current_time):
         """Automatically save images for future training"""
         if not ENABLE_TRAINING_DATA:
             return
         
-        current_time = time.time()
-        
         if car_count > 0:
             # Save image when cars are detected (not too frequently)
             if current_time - self.last_save_time >= 2:  # Save every 2 seconds max
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-                filename = f"{self.dataset_path}/cars/{timestamp}_cars_{car_count}.jpg"
-                cv2.imwrite(filename, frame)
-                logger.info(f"💾 Saved: {filename}")
+                filename = f"{self.dataset_path}/cars/{time.time_ns()}_cars_{car_count}.jpg"
+                self.queue_training_frame(filename, frame)
                 self.last_save_time = current_time
         else:
             # Save occasional empty frames to help balance dataset
             if current_time - self.last_save_time >= 10:  # Save every ~10s when no cars
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-                filename = f"{self.dataset_path}/empty/{timestamp}_empty.jpg"
-                cv2.imwrite(filename, frame)
-                logger.info(f"💾 Saved: {filename}")
+                filename = f"{self.dataset_path}/empty/{time.time_ns()}_empty.jpg"
+                self.queue_training_frame(filename, frame)
                 self.last_save_time = current_time
     
+    def queue_training_frame(self, filename, frame):
+        """Hand a copy of the frame to the writer thread (dropped if the queue is full)"""
+        if self.save_q.full():
+            logger.warning(f"Training frame dropped, writer is behind: {filename}")
+            return
+        try:
+            # Copy - the display thread draws boxes onto the original frame
+            self.save_q.put_nowait((filename, frame.copy()))
+        except queue.Full:
+            logger.warning(f"Training frame dropped, writer is behind: {filename}")
+    
+    def save_writer_loop(self):
+        """Encode training frames to JPEG and write them to disk"""
+        while True:
+            item = self.save_q.get()
+            if item is None:
+                return
+            filename, frame = item
+            try:
+                if not cv2.imwrite(filename, frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]):
+                    logger.error(f"Failed to save {filename}")
+                    continue
+                logger.info(f"💾 Saved: {filename}")
+            except cv2.error as e:
+                logger.error(f"Failed to save {filename}: {e}")
+    
+    def stop_save_writer(self):
+        """Let the writer thread finish pending images and exit"""
+        if self.save_thread:
+            self.save_q.put(None)
+            self.save_thread.join(timeout=5)
+            self.save_thread = None
+    
+    def compose_command(self, light_a, light_b, high_traffic_alert=False):
+        """Build the serial command, e.g. b"AGBR\\n" = A=Green, B=Red (trailing 'H' = alert)"""
+        return f"A{light_a}B{light_b}{'H' if high_traffic_alert else ''}\n".encode()
+    
     def send_commands(self, light_a, light_b, high_traffic_alert=False):
         """Send commands to Arduino for both traffic lights"""
         try:
-            # Only send if state actually changed or high traffic alert
-            if self.light_a == light_a and self.light_b == light_b and not high_traffic_alert:
+            # Only send if the command differs from the last one sent, or for a high traffic alert
+            command = self.compose_command(light_a, light_b)
+            if command == self.last_sent_bytes and not high_traffic_alert:
                 return  # No change needed
             
-            # Send format: "A[command]B[command]" e.g., "AGBR" = A=Green, B=Red
-            command = f"A{light_a}B{light_b}"
-            
-            # Add high traffic alert flag if needed
             if high_traffic_alert:
-                command += "H"  # Add 'H' flag for high traffic mode
-            
-            self.arduino.write(command.encode())
+                self.queue_serial(self.compose_command(light_a, light_b, high_traffic_alert=True))
+            else:
+                self.queue_serial(command)
+            self.last_sent_bytes = command
             
             light_names = {'R': 'RED', 'G': 'GREEN', 'Y': 'YELLOW'}
             if high_traffic_alert:
-                logger.info(f"HIGH TRAFFIC ALERT - Traffic A: {light_names.get(light_a)}, Traffic B: {light_names.get(light_b)}")
+                logger.info("HIGH TRAFFIC ALERT - Traffic A: %s, Traffic B: %s", light_names.get(light_a), light_names.get(light_b))
             else:
-                logger.info(f"CHANGED - Traffic A: {light_names.get(light_a)}, Traffic B: {light_names.get(light_b)}")
+                logger.info("CHANGED - Traffic A: %s, Traffic B: %s", light_names.get(light_a), light_names.get(light_b))
             
             self.light_a = light_a
             self.light_b = light_b
-            self.last_command_time = time.time()
+            self.last_command_time = self.frame_time
             
         except Exception as e:
             logger.error(f"Failed to send command: {e}")
@@ -271,170 +803,155 @@ class DualTrafficLightAI:
         else:  # Yellow
             return 'R'  # When one is yellow, other stays red
     
-    def update_traffic_lights(self, car_count):
+    def update_traffic_lights(self, car_count, current_time):
         """Update traffic light states based on car count and timing"""
-        current_time = time.time()
-        
-        # Handle yellow light transition
-        if self.is_yellow_transition:
-            if current_time - self.yellow_start_time >= YELLOW_DURATION:
-                # Yellow transition complete, determine next state
-                if self.is_high_traffic_mode:
-                    # In high traffic mode, complete the direction switch
-                    if self.high_traffic_direction == 'A':
-                        self.send_commands('G', 'R')  # A gets green
-                    else:
-                        self.send_commands('R', 'G')  # B gets green
-                    
-                    # Restart the 30-second timer for the new direction
-                    self.high_traffic_start_time = current_time
-                    logger.info(f"✅ High traffic alternation complete - Direction {self.high_traffic_direction} gets 30 seconds")
-                
-                elif car_count >= HIGH_TRAFFIC_THRESHOLD:
-                    # Entering high traffic mode after yellow - BUZZ ALERT!
-                    if self.high_traffic_direction == 'A':
-                        self.send_commands('G', 'R', high_traffic_alert=True)
-                    else:
-                        self.send_commands('R', 'G', high_traffic_alert=True)
-                    self.is_high_traffic_mode = True
-                    self.high_traffic_start_time = current_time
-                    logger.info(f"✅ Entered high traffic mode - Direction {self.high_traffic_direction} gets 30 seconds")
-                
-                elif car_count == 0:
-                    # No cars - cross traffic gets green
-                    self.send_commands('R', 'G')
-                    logger.info("Yellow transition complete - Cross traffic active")
-                else:
-                    # Cars detected - AI gets green
-                    self.send_commands('G', 'R')
-                    logger.info(f"Yellow transition complete - AI control active ({car_count} cars)")
-                
-                self.is_yellow_transition = False
+        self.frame_time = current_time
+        
+        # Look up the action for the current state in the transition table
+        state = LightState(self.light_a, self.light_b, self.is_high_traffic_mode, self.is_yellow_transition)
+        action = TRANSITIONS[(state, count_bucket(car_count))]
+        action(self, car_count, current_time)
+    
+    # === Traffic light state machine actions (see build_transitions) ===
+    
+    def hold_lights(self, car_count, current_time):
+        """Lights are already in the right state"""
+    
+    def yellow_done(self, current_time):
+        """Check if the current yellow transition has run for YELLOW_DURATION"""
+        return current_time - self.yellow_start_time >= YELLOW_DURATION
+    
+    def finish_yellow_high_traffic(self, car_count, current_time):
+        """Yellow done in high traffic mode - complete the direction switch"""
+        if not self.yellow_done(current_time):
             return
+        if self.high_traffic_direction == 'A':
+            self.send_commands('G', 'R')  # A gets green
+        else:
+            self.send_commands('R', 'G')  # B gets green
         
-        # Handle high traffic mode (>=8 cars)
-        if car_count >= HIGH_TRAFFIC_THRESHOLD:
-            if not self.is_high_traffic_mode:
-                # Start transition to give other direction green light
-                if self.light_a == 'G':
-                    # A is green, needs yellow transition to red, then B will get green
-                    self.send_commands('Y', 'R')
-                    self.is_yellow_transition = True
-                    self.yellow_start_time = current_time
-                    self.high_traffic_direction = 'B'  # B will get green after transition
-                    logger.info(f"High traffic detected ({car_count} cars) - Starting yellow transition")
-                elif self.light_a == 'R':
-                    # A already red, start high traffic mode with B getting green - BUZZ ALERT!
-                    if self.light_b != 'G':
-                        self.send_commands('R', 'G', high_traffic_alert=True)
-                    else:
-                        # Already in correct state, just set high traffic mode with alert
-                        self.arduino.write(b'H\n')  # Send just high traffic alert
-                    self.is_high_traffic_mode = True
-                    self.high_traffic_start_time = current_time
-                    self.high_traffic_direction = 'B'  # B gets the green first
-                    logger.info(f"High traffic detected ({car_count} cars) - Activating high traffic mode")
-            else:
-                # Already in high traffic mode, check if timer expired
-                if current_time - self.high_traffic_start_time >= HIGH_TRAFFIC_TIMER:
-                    # Timer expired - check if traffic cleared to 0
-                    if car_count == 0:
-                        # Traffic cleared completely, exit high traffic mode
-                        self.is_high_traffic_mode = False
-                        self.send_commands('R', 'G')  # Default: cross traffic gets green when no cars
-                        logger.info("High traffic mode ended - No cars detected, returning to normal")
-                    else:
-                        # Still has traffic (even if below threshold), alternate directions
-                        current_green = self.high_traffic_direction
-                        
-                        # Switch to opposite direction
-                        if self.high_traffic_direction == 'A':
-                            self.high_traffic_direction = 'B'
-                        else:
-                            self.high_traffic_direction = 'A'
-                        
-                        # Start yellow transition to switch directions
-                        if current_green == 'A':
-                            # A was green, start A yellow transition
-                            self.send_commands('Y', 'R')
-                        else:
-                            # B was green, start B yellow transition  
-                            self.send_commands('R', 'Y')
-                        
-                        self.is_yellow_transition = True
-                        self.yellow_start_time = current_time
-                        logger.info(f"High traffic alternation - {car_count} cars remain, switching to direction {self.high_traffic_direction}")
-                        
-                        # Don't restart high traffic timer yet - wait for yellow to complete
-        
-        # Normal traffic mode (<8 cars but not 0) OR exiting high traffic
+        # Restart the 30-second timer for the new direction
+        self.high_traffic_start_time = current_time
+        logger.info("✅ High traffic alternation complete - Direction %s gets 30 seconds", self.high_traffic_direction)
+        self.is_yellow_transition = False
+    
+    def finish_yellow_enter_high_traffic(self, car_count, current_time):
+        """Yellow done with >=8 cars - enter high traffic mode with BUZZ ALERT!"""
+        if not self.yellow_done(current_time):
+            return
+        if self.high_traffic_direction == 'A':
+            self.send_commands('G', 'R', high_traffic_alert=True)
         else:
-            if self.is_high_traffic_mode:
-                # Was in high traffic mode, traffic reduced below threshold
-                # Only exit when car count reaches 0
-                if car_count == 0:
-                    # Exit high traffic mode completely
-                    self.is_high_traffic_mode = False
-                    self.send_commands('R', 'G')  # Cross traffic gets green
-                    logger.info("Exiting high traffic mode - No cars detected")
-                else:
-                    # Car count dropped below 8 but not 0 yet
-                    # Continue alternating until it reaches 0
-                    if current_time - self.high_traffic_start_time >= HIGH_TRAFFIC_TIMER:
-                        # Timer expired, alternate even though below threshold
-                        current_green = self.high_traffic_direction
-                        
-                        # Switch to opposite direction
-                        if self.high_traffic_direction == 'A':
-                            self.high_traffic_direction = 'B'
-                        else:
-                            self.high_traffic_direction = 'A'
-                        
-                        # Start yellow transition to switch directions
-                        if current_green == 'A':
-                            self.send_commands('Y', 'R')
-                        else:
-                            self.send_commands('R', 'Y')
-                        
-                        self.is_yellow_transition = True
-                        self.yellow_start_time = current_time
-                        logger.info(f"High traffic mode continuing - {car_count} cars (below threshold but not 0), switching to direction {self.high_traffic_direction}")
-            else:
-                # Normal AI control logic
-                if car_count == 0:
-                    # No cars detected - give cross traffic the green
-                    if self.light_a == 'G':
-                        # Need to transition from green to red with yellow buffer
-                        self.send_commands('Y', 'R')
-                        self.is_yellow_transition = True
-                        self.yellow_start_time = current_time
-                        logger.info("No cars detected - Starting yellow transition to cross traffic")
-                    elif self.light_a == 'R':
-                        # Already red, just make sure B is green
-                        if self.light_b != 'G':
-                            self.send_commands('R', 'G')
-                
-                elif car_count >= 1:
-                    # Any cars detected (1-7) - give AI side the green
-                    if self.light_a == 'R':
-                        # Need to transition from red to green - first yellow B, then switch
-                        if self.light_b == 'G':
-                            # B needs to go from green to red via yellow
-                            self.send_commands('R', 'Y')
-                            self.is_yellow_transition = True
-                            self.yellow_start_time = current_time
-                            logger.info(f"Cars detected ({car_count}) - Starting yellow transition to AI control")
-                        else:
-                            # B already not green, can switch A to green
-                            self.send_commands('G', 'R')
-                    elif self.light_a == 'G':
-                        # Already green, just make sure B is red
-                        if self.light_b != 'R':
-                            self.send_commands('G', 'R')
-    
-    def draw_interface(self, frame, car_count, confirmed_count):
-        """Draw all interface elements on frame"""
-        current_time = time.time()
+            self.send_commands('R', 'G', high_traffic_alert=True)
+        self.is_high_traffic_mode = True
+        self.high_traffic_start_time = current_time
+        logger.info("✅ Entered high traffic mode - Direction %s gets 30 seconds", self.high_traffic_direction)
+        self.is_yellow_transition = False
+    
+    def finish_yellow_cross_traffic(self, car_count, current_time):
+        """Yellow done with no cars - cross traffic gets green"""
+        if not self.yellow_done(current_time):
+            return
+        self.send_commands('R', 'G')
+        logger.info("Yellow transition complete - Cross traffic active")
+        self.is_yellow_transition = False
+    
+    def finish_yellow_ai_control(self, car_count, current_time):
+        """Yellow done with cars detected - AI gets green"""
+        if not self.yellow_done(current_time):
+            return
+        self.send_commands('G', 'R')
+        logger.info("Yellow transition complete - AI control active (%d cars)", car_count)
+        self.is_yellow_transition = False
+    
+    def start_high_traffic_yellow(self, car_count, current_time):
+        """A is green, needs yellow transition to red, then B will get green"""
+        self.send_commands('Y', 'R')
+        self.is_yellow_transition = True
+        self.yellow_start_time = current_time
+        self.high_traffic_direction = 'B'  # B will get green after transition
+        logger.info("High traffic detected (%d cars) - Starting yellow transition", car_count)
+    
+    def activate_high_traffic(self, car_count, current_time):
+        """A already red, start high traffic mode with B getting green - BUZZ ALERT!"""
+        self.send_commands('R', 'G', high_traffic_alert=True)
+        self.start_high_traffic_mode(car_count, current_time)
+    
+    def alert_high_traffic(self, car_count, current_time):
+        """Already in correct state, just set high traffic mode with alert"""
+        self.queue_serial(b'H\n')  # Send just high traffic alert
+        self.start_high_traffic_mode(car_count, current_time)
+    
+    def start_high_traffic_mode(self, car_count, current_time):
+        """Enter high traffic mode with B getting the green first"""
+        self.is_high_traffic_mode = True
+        self.high_traffic_start_time = current_time
+        self.high_traffic_direction = 'B'  # B gets the green first
+        logger.info("High traffic detected (%d cars) - Activating high traffic mode", car_count)
+    
+    def switch_high_traffic_direction(self, current_time):
+        """Start a yellow transition handing the green to the other direction"""
+        current_green = self.high_traffic_direction
+        
+        # Switch to opposite direction
+        self.high_traffic_direction = 'B' if current_green == 'A' else 'A'
+        
+        # Start yellow transition to switch directions
+        if current_green == 'A':
+            # A was green, start A yellow transition
+            self.send_commands('Y', 'R')
+        else:
+            # B was green, start B yellow transition
+            self.send_commands('R', 'Y')
+        
+        self.is_yellow_transition = True
+        self.yellow_start_time = current_time
+        # Don't restart high traffic timer yet - wait for yellow to complete
+    
+    def alternate_high_traffic(self, car_count, current_time):
+        """Still >=8 cars - alternate directions when the 30-second timer expires"""
+        if current_time - self.high_traffic_start_time >= HIGH_TRAFFIC_TIMER:
+            self.switch_high_traffic_direction(current_time)
+            logger.info("High traffic alternation - %d cars remain, switching to direction %s",
+                        car_count, self.high_traffic_direction)
+    
+    def continue_high_traffic(self, car_count, current_time):
+        """Car count dropped below 8 but not 0 yet - keep alternating until it reaches 0"""
+        if current_time - self.high_traffic_start_time >= HIGH_TRAFFIC_TIMER:
+            self.switch_high_traffic_direction(current_time)
+            logger.info("High traffic mode continuing - %d cars (below threshold but not 0), switching to direction %s",
+                        car_count, self.high_traffic_direction)
+    
+    def exit_high_traffic(self, car_count, current_time):
+        """No cars left - exit high traffic mode completely"""
+        self.is_high_traffic_mode = False
+        self.send_commands('R', 'G')  # Cross traffic gets green
+        logger.info("Exiting high traffic mode - No cars detected")
+    
+    def start_yellow_to_cross(self, car_count, current_time):
+        """No cars detected - transition A from green to red with yellow buffer"""
+        self.send_commands('Y', 'R')
+        self.is_yellow_transition = True
+        self.yellow_start_time = current_time
+        logger.info("No cars detected - Starting yellow transition to cross traffic")
+    
+    def start_yellow_to_ai(self, car_count, current_time):
+        """Cars detected - B needs to go from green to red via yellow"""
+        self.send_commands('R', 'Y')
+        self.is_yellow_transition = True
+        self.yellow_start_time = current_time
+        logger.info("Cars detected (%d) - Starting yellow transition to AI control", car_count)
+    
+    def give_cross_green(self, car_count, current_time):
+        """A already red, just make sure B is green"""
+        self.send_commands('R', 'G')
+    
+    def give_ai_green(self, car_count, current_time):
+        """B not green, A can switch to (or stay) green"""
+        self.send_commands('G', 'R')
+    
+    def draw_interface(self, frame, car_count, confirmed_count, current_time, hud):
+        """Draw all interface elements on frame (hud = HudState snapshot taken by the main loop)"""
         
         # Draw raw car count (what's currently detected)
         cv2.putText(frame, f"Detected Now: {car_count}", (10, 25), 
@@ -446,14 +963,14 @@ class DualTrafficLightAI:
         
         # Show if detection is pending confirmation
         if car_count != confirmed_count:
-            time_elapsed = current_time - self.last_state_change_time
+            time_elapsed = current_time - hud.last_state_change_time
             remaining = DETECTION_CONFIRMATION_TIME - time_elapsed
             if remaining > 0:
                 cv2.putText(frame, f"Confirming... {remaining:.1f}s", (10, 75), 
                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 165, 255), 1)
         
         # Draw FPS
-        cv2.putText(frame, f"FPS: {self.current_fps}", (10, 95), 
+        cv2.putText(frame, f"FPS: {hud.fps}", (10, 95), 
                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
         
         # Draw traffic light states
@@ -461,141 +978,457 @@ class DualTrafficLightAI:
         light_names = {'G': 'GREEN', 'Y': 'YELLOW', 'R': 'RED'}
         
         # Traffic Light A (AI-controlled)
-        color_a = light_colors.get(self.light_a, (255, 255, 255))
-        cv2.putText(frame, f"Traffic A (AI): {light_names.get(self.light_a)}", (10, 120), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.6, color_a, 2)
+        color_a = light_colors.get(hud.light_a, (255, 255, 255))
+        self.draw_cached_text(frame, f"Traffic A (AI): {light_names.get(hud.light_a)}", (10, 120), 0.6, color_a, 2)
         
         # Traffic Light B (Opposite)
-        color_b = light_colors.get(self.light_b, (255, 255, 255))
-        cv2.putText(frame, f"Traffic B: {light_names.get(self.light_b)}", (10, 145), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.6, color_b, 2)
+        color_b = light_colors.get(hud.light_b, (255, 255, 255))
+        self.draw_cached_text(frame, f"Traffic B: {light_names.get(hud.light_b)}", (10, 145), 0.6, color_b, 2)
         
         # Draw mode and timing info
-        if self.is_yellow_transition:
-            remaining = YELLOW_DURATION - (current_time - self.yellow_start_time)
+        if hud.is_yellow_transition:
+            remaining = YELLOW_DURATION - (current_time - hud.yellow_start_time)
             cv2.putText(frame, f"YELLOW TRANSITION: {remaining:.1f}s", (10, 170), 
                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
         
-        elif self.is_high_traffic_mode:
-            remaining = HIGH_TRAFFIC_TIMER - (current_time - self.high_traffic_start_time)
-            direction_name = "AI Side (A)" if self.high_traffic_direction == 'A' else "Cross Traffic (B)"
+        elif hud.is_high_traffic_mode:
+            remaining = HIGH_TRAFFIC_TIMER - (current_time - hud.high_traffic_start_time)
+            direction_name = "AI Side (A)" if hud.high_traffic_direction == 'A' else "Cross Traffic (B)"
             cv2.putText(frame, f"HIGH TRAFFIC: {direction_name} - {remaining:.1f}s", (10, 170), 
                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 100, 255), 1)
         
         elif confirmed_count >= HIGH_TRAFFIC_THRESHOLD:
-            cv2.putText(frame, f"HIGH TRAFFIC DETECTED!", (10, 170), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
+            self.draw_cached_text(frame, "HIGH TRAFFIC DETECTED!", (10, 170), 0.5, (0, 0, 255), 1)
         
         else:
-            cv2.putText(frame, "NORMAL MODE", (10, 170), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+            self.draw_cached_text(frame, "NORMAL MODE", (10, 170), 0.5, (0, 255, 0), 1)
+        
+        # Static labels (threshold info, controls, light housings) come from a cached overlay
+        self.draw_static_overlay(frame)
+        
+        # Draw traffic light visualization
+        self.draw_traffic_lights(frame, hud)
+    
+    def build_static_overlay(self, shape):
+        """Pre-render the text and boxes that never change, for the given frame shape"""
+        height, width = shape[:2]
+        overlay = np.zeros((height, width, 4), np.uint8)
         
         # Draw threshold info
-        cv2.putText(frame, f"AI Control: >=1 car | Cross Traffic: 0 cars | High Traffic: >=8 cars", (10, 195), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
+        cv2.putText(overlay, f"AI Control: >=1 car | Cross Traffic: 0 cars | High Traffic: >=8 cars", (10, 195), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255, 255), 1)
         
         # Draw confirmation info
-        cv2.putText(frame, f"Detection Delay: {DETECTION_CONFIRMATION_TIME}s (reduces false positives)", (10, 215), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.4, (200, 200, 200), 1)
+        cv2.putText(overlay, f"Detection Delay: {DETECTION_CONFIRMATION_TIME}s (reduces false positives)", (10, 215), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.4, (200, 200, 200, 255), 1)
         
         # Draw controls
-        cv2.putText(frame, "Controls: 'q' = quit, 'r' = reset", (10, frame.shape[0] - 10), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
+        cv2.putText(overlay, "Controls: 'q' = quit, 'r' = reset", (10, height - 10), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255, 255), 1)
         
-        # Draw traffic light visualization
-        self.draw_traffic_lights(frame)
+        # Traffic light labels
+        start_x = width - 200
+        start_y = 50
+        cv2.putText(overlay, "Traffic A", (start_x - 10, start_y - 15), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255, 255), 1)
+        cv2.putText(overlay, "Traffic B", (start_x + 70, start_y - 15), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255, 255), 1)
+        
+        # Only keep the drawn pixels (and their alpha for anti-aliased edges) for blitting.
+        # Text is drawn on a black background, so the colour channels are premultiplied by alpha.
+        mask = overlay[:, :, 3] > 0
+        self.static_mask = mask
+        self.static_pixels = overlay[:, :, :3][mask].astype(np.uint16)
+        self.static_alpha = overlay[:, :, 3][mask].astype(np.uint16)[:, None]
+        self.static_shape = shape
+    
+    def draw_static_overlay(self, frame):
+        """Copy the cached static overlay onto the frame"""
+        if self.static_shape != frame.shape:
+            self.build_static_overlay(frame.shape)
+        background = frame[self.static_mask].astype(np.uint16)
+        blended = self.static_pixels + (background * (255 - self.static_alpha) + 127) // 255
+        frame[self.static_mask] = np.minimum(blended, 255).astype(np.uint8)
+    
+    def draw_cached_text(self, frame, text, org, font_scale, color, thickness):
+        """Same as cv2.putText with FONT_HERSHEY_SIMPLEX, but the label is rasterized once and then copied"""
+        key = (text, font_scale, color, thickness)
+        entry = self.text_masks.get(key)
+        if entry is None:
+            (text_width, text_height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+            pad = thickness + 4
+            mask = np.zeros((text_height + baseline + 2 * pad, text_width + 2 * pad), np.uint8)
+            cv2.putText(mask, text, (pad, text_height + pad), cv2.FONT_HERSHEY_SIMPLEX, font_scale, 255, thickness)
+            sprite = np.zeros(mask.shape + (3,), np.uint8)
+            sprite[mask > 0] = color
+            entry = (sprite, mask, pad, text_height + pad)
+            self.text_masks[key] = entry
+        
+        sprite, mask, offset_x, offset_y = entry
+        x, y = org[0] - offset_x, org[1] - offset_y
+        if x < 0 or y < 0 or y + mask.shape[0] > frame.shape[0] or x + mask.shape[1] > frame.shape[1]:
+            # Label would be clipped by the frame edge - let OpenCV handle it
+            cv2.putText(frame, text, org, cv2.FONT_HERSHEY_SIMPLEX, font_scale, color, thickness)
+            return
+        cv2.copyTo(sprite, mask, frame[y:y + mask.shape[0], x:x + mask.shape[1]])
+    
+    def get_light_patch(self, light):
+        """Get the pre-rendered traffic light housing (60x100 box with 3 lamps) for a state"""
+        patch = self.light_patches.get(light)
+        if patch is None:
+            # Housing box spans (-10, -10) to (+50, +90) around the light origin
+            patch = np.full((101, 61, 3), 50, np.uint8)
+            colors = {'R': (64, 64, 64), 'Y': (64, 64, 64), 'G': (64, 64, 64)}
+            if light == 'R':
+                colors['R'] = (0, 0, 255)
+            elif light == 'Y':
+                colors['Y'] = (0, 255, 255)
+            elif light == 'G':
+                colors['G'] = (0, 255, 0)
+            
+            cv2.circle(patch, (30, 25), 12, colors['R'], -1)  # Red
+            cv2.circle(patch, (30, 50), 12, colors['Y'], -1)  # Yellow
+            cv2.circle(patch, (30, 75), 12, colors['G'], -1)  # Green
+            
+            # Add white borders
+            cv2.circle(patch, (30, 25), 12, (255, 255, 255), 2)
+            cv2.circle(patch, (30, 50), 12, (255, 255, 255), 2)
+            cv2.circle(patch, (30, 75), 12, (255, 255, 255), 2)
+            self.light_patches[light] = patch
+        return patch
     
-    def draw_traffic_lights(self, frame):
+    def draw_traffic_lights(self, frame, hud):
         """Draw visual traffic light representation"""
         # Position for traffic lights
         start_x = frame.shape[1] - 200
         start_y = 50
         
-        # Draw background boxes for traffic lights
-        cv2.rectangle(frame, (start_x - 10, start_y - 10), (start_x + 50, start_y + 90), (50, 50, 50), -1)
-        cv2.rectangle(frame, (start_x + 70, start_y - 10), (start_x + 130, start_y + 90), (50, 50, 50), -1)
-        
         # Traffic Light A
-        cv2.putText(frame, "Traffic A", (start_x - 10, start_y - 15), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        np.copyto(frame[start_y - 10:start_y + 91, start_x - 10:start_x + 51], self.get_light_patch(hud.light_a))
         
-        # Draw circles for A
-        colors_a = {'R': (64, 64, 64), 'Y': (64, 64, 64), 'G': (64, 64, 64)}
-        if self.light_a == 'R':
-            colors_a['R'] = (0, 0, 255)
-        elif self.light_a == 'Y':
-            colors_a['Y'] = (0, 255, 255)
-        elif self.light_a == 'G':
-            colors_a['G'] = (0, 255, 0)
+        # Traffic Light B
+        np.copyto(frame[start_y - 10:start_y + 91, start_x + 70:start_x + 131], self.get_light_patch(hud.light_b))
+    
+    def draw_custom_detections(self, frame, detections):
+        """Draw custom detection boxes with smaller text and thinner lines"""
+        # detections is an (N, 6) array of x1, y1, x2, y2, confidence, class
+        cars = detections[detections[:, 5] == self.car_class_id]
+        boxes = cars[:, :4].astype(np.int32).tolist()  # One conversion for all boxes
         
-        cv2.circle(frame, (start_x + 20, start_y + 15), 12, colors_a['R'], -1)  # Red
-        cv2.circle(frame, (start_x + 20, start_y + 40), 12, colors_a['Y'], -1)  # Yellow
-        cv2.circle(frame, (start_x + 20, start_y + 65), 12, colors_a['G'], -1)  # Green
+        # Smaller font size (0.3 instead of default 0.5)
+        font_scale = 0.3
+        thickness = 1
         
-        # Add white borders
-        cv2.circle(frame, (start_x + 20, start_y + 15), 12, (255, 255, 255), 2)
-        cv2.circle(frame, (start_x + 20, start_y + 40), 12, (255, 255, 255), 2)
-        cv2.circle(frame, (start_x + 20, start_y + 65), 12, (255, 255, 255), 2)
+        for (x1, y1, x2, y2), confidence in zip(boxes, cars[:, 4].tolist()):
+            # Draw thinner bounding box (thickness=1 instead of default 2-3)
+            cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 1)  # Thinner blue box
+            
+            # Draw smaller label text
+            label = f"car {confidence:.2f}"
+            
+            # Get text size for background
+            (text_width, text_height), baseline = cv2.getTextSize(
+                label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness
+            )
+            
+            # Draw background rectangle for text (smaller)
+            cv2.rectangle(frame, 
+                        (x1, y1 - text_height - baseline - 2), 
+                        (x1 + text_width, y1), 
+                        (255, 0, 0), -1)
+            
+            # Draw text (smaller) - confidence labels repeat, so they come from the label cache
+            self.draw_cached_text(frame, label, (x1, y1 - baseline - 2), font_scale, (255, 255, 255), thickness)
         
-        # Traffic Light B
-        cv2.putText(frame, "Traffic B", (start_x + 70, start_y - 15), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        return frame
+    
+    def put_latest(self, q, item):
+        """Put item on a bounded queue, dropping the oldest entry if it is full"""
+        while not self.stop_event.is_set():
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()  # Drop stale entry so we always work on fresh data
+                except queue.Empty:
+                    pass
+    
+    def capture_loop(self):
+        """Thread A: read frames from the camera into frame_q"""
+        while not self.stop_event.is_set():
+            ret, frame = self.cap.read()
+            if not ret:
+                logger.error("Failed to grab frame")
+                self.put_latest(self.frame_q, None)  # Tell downstream stages to stop
+                return
+            self.put_latest(self.frame_q, (frame, time.monotonic()))
+    
+    def inference_loop(self):
+        """Thread B: run YOLO on frames from frame_q and push results to result_q"""
+        while not self.stop_event.is_set():
+            try:
+                item = self.frame_q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is None:
+                self.put_latest(self.result_q, None)
+                return
+            frame, t = item
+            
+            # Only run YOLO every skip_frames frames (and on motion), reuse last detections otherwise
+            fresh = self.should_detect(frame)
+            if fresh:
+                try:
+                    # inference_mode is thread-local, so it has to be entered in this thread
+                    with torch.inference_mode():
+                        self.run_detection(frame)
+                except Exception as e:
+                    logger.error(f"Inference failed: {e}")
+                    self.put_latest(self.result_q, None)
+                    return
+            
+            self.put_latest(self.result_q, (frame, self.last_detections, t))
+    
+    def should_detect(self, frame):
+        """Decide if YOLO runs on this frame: every skip_frames frames while there is motion, at least every MOTION_MAX_SKIP"""
+        motion = self.has_motion(frame) if MOTION_GATE else True
+        if self.last_detections is None or self.frames_since_detection + 1 >= MOTION_MAX_SKIP:
+            fresh = True
+        else:
+            fresh = motion and self.frame_idx % self.skip_frames == 0
+        self.frame_idx += 1
+        self.frames_since_detection = 0 if fresh else self.frames_since_detection + 1
+        return fresh
+    
+    def has_motion(self, frame):
+        """Background subtraction on a thumbnail, True if enough pixels changed"""
+        small = cv2.resize(frame, (160, 90), interpolation=cv2.INTER_AREA)
+        mask = self.bg_subtractor.apply(small)
+        return cv2.countNonZero(mask) > MOTION_THRESHOLD * mask.size
+    
+    def run_detection(self, frame):
+        """Run YOLO on frame and store last_detections"""
+        start = time.monotonic()
+        if self.host_buf is not None:
+            # CUDA: pinned-memory upload
+            self.last_detections = self.infer_pinned(frame)
+        else:
+            self.last_detections = self.detect_autoshape(self.model, frame)
+        self.record_infer_time(time.monotonic() - start)
+    
+    def record_infer_time(self, seconds):
+        """Keep a smoothed YOLO run time for adapt_skip_frames"""
+        self.infer_time = seconds if self.infer_time is None else 0.9 * self.infer_time + 0.1 * seconds
+    
+    def detect_autoshape_timed(self, model, frame):
+        """detect_autoshape for AsyncPredictor workers, also recording the run time"""
+        start = time.monotonic()
+        detections = self.detect_autoshape(model, frame)
+        self.record_infer_time(time.monotonic() - start)
+        return detections
+    
+    def detect_autoshape(self, model, frame):
+        """Run an AutoShape model on frame, returns (N, 6) detections in frame coordinates"""
+        infer_frame, scale = self.resize_for_inference(frame)
+        with torch.inference_mode():
+            results = model(infer_frame, size=INFER_SIZE)
+        detections = results.xyxy[0].cpu().numpy()
+        if scale != 1:
+            detections[:, :4] *= scale
+        return detections
+    
+    def async_inference_loop(self):
+        """Thread B with several engines: keep one frame in flight per engine, publish in capture order"""
+        inflight = deque()  # (frame, timestamp, future or None for skipped frames)
+        while not self.stop_event.is_set():
+            try:
+                item = self.frame_q.get(timeout=0.01 if inflight else 0.5)
+            except queue.Empty:
+                item = False
+            
+            if item is None:
+                # Capture ended - flush what is still in flight, then stop downstream
+                while inflight:
+                    if not self.publish_oldest(inflight):
+                        return
+                self.put_latest(self.result_q, None)
+                return
+            
+            if item:
+                frame, t = item
+                fresh = self.should_detect(frame)
+                inflight.append((frame, t, self.predictor.submit(frame) if fresh else None))
+            
+            # Publish the oldest frame once its engine finished or when every engine is busy
+            while inflight and (inflight[0][2] is None or inflight[0][2].done()
+                                or len(inflight) > self.predictor.size):
+                if not self.publish_oldest(inflight):
+                    return
+    
+    def publish_oldest(self, inflight):
+        """Wait for the oldest in-flight frame and push it to result_q, returns False on inference error"""
+        frame, t, future = inflight.popleft()
+        if future is not None:
+            try:
+                self.last_detections = future.result()
+            except Exception as e:
+                logger.error(f"Inference failed: {e}")
+                self.put_latest(self.result_q, None)
+                return False
+        if self.last_detections is None:
+            return True  # Nothing detected yet to show with a skipped frame
+        self.put_latest(self.result_q, (frame, self.last_detections, t))
+        return True
+    
+    def resize_for_inference(self, frame):
+        """Downscale frame so its long side is INFER_SIZE, returns (image, scale back to frame)"""
+        height, width = frame.shape[:2]
+        scale = max(height, width) / INFER_SIZE
+        if scale <= 1:
+            return frame, 1
+        size = (round(width / scale), round(height / scale))
+        
+        # Resize into a preallocated buffer (one per thread, predictor workers resize concurrently)
+        small = getattr(self.infer_bufs, 'buf', None)
+        if small is None or small.shape[:2] != (size[1], size[0]):
+            small = np.empty((size[1], size[0], 3), np.uint8)
+            self.infer_bufs.buf = small
+        cv2.resize(frame, size, dst=small, interpolation=cv2.INTER_LINEAR)
+        return small, scale
+    
+    def letterbox_geometry(self, frame):
+        """Letterbox scale, resized size and padding for frame, returns (ratio, new_w, new_h, pad_x, pad_y)"""
+        height, width = frame.shape[:2]
+        ratio = INFER_SIZE / max(height, width)
+        new_w, new_h = round(width * ratio), round(height * ratio)
+        return ratio, new_w, new_h, (INFER_SIZE - new_w) // 2, (INFER_SIZE - new_h) // 2
+    
+    def letterbox(self, frame):
+        """Resize and pad frame into the fixed INFER_SIZE square buffer, returns (ratio, pad_x, pad_y)"""
+        ratio, new_w, new_h, pad_x, pad_y = self.letterbox_geometry(frame)
+        if self.letterbox_shape != frame.shape:
+            self.letterbox_buf[:] = 114  # Grey padding, same as YOLOv5
+            self.letterbox_shape = frame.shape
+        roi = self.letterbox_buf[pad_y:pad_y + new_h, pad_x:pad_x + new_w]
+        if ratio == 1:
+            np.copyto(roi, frame)
+        else:
+            cv2.resize(frame, (new_w, new_h), dst=roi, interpolation=cv2.INTER_LINEAR)
+        return ratio, pad_x, pad_y
+    
+    def gpu_letterbox(self, frame):
+        """Upload the raw uint8 frame and letterbox it on the GPU, returns (input tensor, ratio, pad_x, pad_y)"""
+        ratio, new_w, new_h, pad_x, pad_y = self.letterbox_geometry(frame)
+        if self.frame_host_buf is None or self.frame_host_buf.shape != frame.shape:
+            self.frame_host_buf = torch.empty(frame.shape, dtype=torch.uint8, pin_memory=True)
+            self.gpu_input = torch.full((1, 3, INFER_SIZE, INFER_SIZE), 114 / 255,
+                                        dtype=torch.float16, device=self.device)  # Grey padding
+        self.frame_host_buf.copy_(torch.from_numpy(frame))
         
-        # Draw circles for B
-        colors_b = {'R': (64, 64, 64), 'Y': (64, 64, 64), 'G': (64, 64, 64)}
-        if self.light_b == 'R':
-            colors_b['R'] = (0, 0, 255)
-        elif self.light_b == 'Y':
-            colors_b['Y'] = (0, 255, 255)
-        elif self.light_b == 'G':
-            colors_b['G'] = (0, 255, 0)
+        # Resize and normalize on the device, straight into the padded input
+        img = self.frame_host_buf.to(self.device, non_blocking=True).permute(2, 0, 1).unsqueeze(0).half()
+        if ratio != 1:
+            img = torch.nn.functional.interpolate(img, size=(new_h, new_w), mode='bilinear', align_corners=False)
+        self.gpu_input[:, :, pad_y:pad_y + new_h, pad_x:pad_x + new_w] = img.div_(255)
+        return self.gpu_input, ratio, pad_x, pad_y
+    
+    def infer_pinned(self, frame):
+        """Run YOLO on CUDA via the pinned input buffer, returns (N, 6) detections in frame coordinates"""
+        if not GPU_PREPROCESS:
+            ratio, pad_x, pad_y = self.letterbox(frame)
+            # HWC uint8 -> NCHW fp16 straight into pinned memory, then async upload on the side stream
+            self.host_buf[0].copy_(torch.from_numpy(self.letterbox_buf).permute(2, 0, 1))
         
-        cv2.circle(frame, (start_x + 100, start_y + 15), 12, colors_b['R'], -1)  # Red
-        cv2.circle(frame, (start_x + 100, start_y + 40), 12, colors_b['Y'], -1)  # Yellow
-        cv2.circle(frame, (start_x + 100, start_y + 65), 12, colors_b['G'], -1)  # Green
+        with torch.cuda.stream(self.cuda_stream):
+            if GPU_PREPROCESS:
+                dev_in, ratio, pad_x, pad_y = self.gpu_letterbox(frame)
+            else:
+                dev_in = self.host_buf.to(self.device, non_blocking=True).div_(255)
+            pred = self.model(dev_in)  # Tensor input skips AutoShape pre/post-processing
+            pred = pred[0] if isinstance(pred, (list, tuple)) else pred
+            det = self.non_max_suppression(pred[0].float())
+            det = det.cpu().numpy()
         
-        # Add white borders
-        cv2.circle(frame, (start_x + 100, start_y + 15), 12, (255, 255, 255), 2)
-        cv2.circle(frame, (start_x + 100, start_y + 40), 12, (255, 255, 255), 2)
-        cv2.circle(frame, (start_x + 100, start_y + 65), 12, (255, 255, 255), 2)
+        # Undo letterbox padding and scaling
+        det[:, [0, 2]] -= pad_x
+        det[:, [1, 3]] -= pad_y
+        det[:, :4] /= ratio
+        return det
     
-    def draw_custom_detections(self, frame, detections):
-        """Draw custom detection boxes with smaller text and thinner lines"""
-        for _, det in detections.iterrows():
-            if det['name'] == 'car':
-                x1, y1, x2, y2 = int(det['xmin']), int(det['ymin']), int(det['xmax']), int(det['ymax'])
-                confidence = det['confidence']
-                
-                # Draw thinner bounding box (thickness=1 instead of default 2-3)
-                cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 1)  # Thinner blue box
-                
-                # Draw smaller label text
-                label = f"car {confidence:.2f}"
-                
-                # Smaller font size (0.3 instead of default 0.5)
-                font_scale = 0.3
-                thickness = 1
-                
-                # Get text size for background
-                (text_width, text_height), baseline = cv2.getTextSize(
-                    label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness
-                )
+    def non_max_suppression(self, pred):
+        """Filter raw YOLOv5 output (N, 5 + classes) into (N, 6) x1, y1, x2, y2, confidence, class"""
+        pred = pred[pred[:, 4] > self.model.conf]
+        conf, cls = (pred[:, 5:] * pred[:, 4:5]).max(1)
+        keep = conf > self.model.conf
+        if DETECT_ONLY_CARS:
+            keep &= cls == self.car_class_id
+        pred, conf, cls = pred[keep], conf[keep], cls[keep]
+        
+        # Center xywh to corner xyxy
+        boxes = torch.cat((pred[:, :2] - pred[:, 2:4] / 2, pred[:, :2] + pred[:, 2:4] / 2), 1)
+        idx = torchvision.ops.batched_nms(boxes, conf, cls, self.model.iou)[:self.model.max_det]
+        return torch.cat((boxes[idx], conf[idx, None], cls[idx, None].float()), 1)
+    
+    def start_pipeline(self):
+        """Start capture, inference and (unless headless) display worker threads"""
+        self.stop_event.clear()
+        inference_target = self.async_inference_loop if self.predictor else self.inference_loop
+        self.threads = [
+            threading.Thread(target=self.capture_loop, name="capture", daemon=True),
+            threading.Thread(target=inference_target, name="inference", daemon=True),
+        ]
+        if not self.headless:
+            self.threads.append(threading.Thread(target=self.display_loop, name="display", daemon=True))
+        for thread in self.threads:
+            thread.start()
+    
+    def display_loop(self):
+        """Thread C: draw the newest frame from display_q, show it and handle window keys"""
+        while not self.stop_event.is_set():
+            try:
+                frame, detections, raw_car_count, car_count, current_time, hud = self.display_q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            
+            try:
+                # Draw detections straight onto the captured frame (it is not used after this)
+                self.draw_custom_detections(frame, detections)
                 
-                # Draw background rectangle for text (smaller)
-                cv2.rectangle(frame, 
-                            (x1, y1 - text_height - baseline - 2), 
-                            (x1 + text_width, y1), 
-                            (255, 0, 0), -1)
+                # Draw interface (show both raw and confirmed counts)
+                self.draw_interface(frame, raw_car_count, car_count, current_time, hud)
                 
-                # Draw text (smaller)
-                cv2.putText(frame, label, 
-                          (x1, y1 - baseline - 2), 
-                          cv2.FONT_HERSHEY_SIMPLEX, 
-                          font_scale, 
-                          (255, 255, 255), 
-                          thickness)
-        
-        return frame
+                # Show frame
+                cv2.imshow('Dual Traffic Light AI System', frame)
+            except Exception as e:
+                # Keep the window (and its 'q' key) alive if one frame fails to draw
+                logger.error(f"Failed to display frame: {e}")
+            
+            # Handle keyboard input - acted on by the main loop
+            self.handle_key(self.read_window_key())
+        cv2.destroyAllWindows()
+    
+    def hud_snapshot(self):
+        """Copy the state draw_interface needs, taken on the main thread between state machine updates"""
+        return HudState(self.light_a, self.light_b, self.is_yellow_transition, self.yellow_start_time,
+                        self.is_high_traffic_mode, self.high_traffic_start_time, self.high_traffic_direction,
+                        self.last_state_change_time, self.current_fps)
+    
+    def handle_key(self, key):
+        """Signal the main loop: 'q' = quit, 'r' = reset"""
+        if key == ord('q'):
+            self.quit_event.set()
+        elif key == ord('r'):
+            self.reset_event.set()
+    
+    def stop_pipeline(self):
+        """Signal worker threads to stop and wait for them to finish"""
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout=2)
+        self.threads = []
+        if self.predictor:
+            self.predictor.shutdown()
     
     def run(self, source):
         """Main detection loop"""
@@ -606,58 +1439,66 @@ class DualTrafficLightAI:
             self.setup_camera(source)
             
             # Initialize traffic lights
+            self.frame_time = time.monotonic()
             self.send_commands('R', 'G')  # Start with A=Red (no cars), B=Green (cross traffic)
             
             logger.info("Starting Dual Traffic Light AI System...")
+            if self.headless:
+                logger.info("Headless mode - no video window, type 'q' or 'r' + Enter in the console")
+            
+            # Capture, inference and display run in their own threads, main thread handles the lights
+            self.start_pipeline()
             
             while True:
-                ret, frame = self.cap.read()
-                if not ret:
-                    logger.error("Failed to grab frame")
+                try:
+                    item = self.result_q.get(timeout=1)
+                except queue.Empty:
+                    # No frames (camera stalled) - still honour 'q'
+                    if self.headless:
+                        self.handle_key(self.read_console_key())
+                    if self.quit_event.is_set():
+                        logger.info("Quit requested by user")
+                        break
+                    continue
+                if item is None:
                     break
+                frame, detections, frame_time = item
                 
-                # Calculate FPS
-                self.calculate_fps()
+                # Sample the clock once per frame and use it for all timing decisions
+                now = time.monotonic()
                 
-                # Run YOLO detection
-                results = self.model(frame)
-                detections = results.xyxy[0]
+                # Calculate FPS
+                self.calculate_fps(now)
                 
                 # Count cars (raw detection)
                 raw_car_count = self.count_cars(detections)
                 
                 # Get confirmed car count (with temporal smoothing)
-                car_count = self.get_confirmed_car_count(raw_car_count)
+                car_count = self.get_confirmed_car_count(raw_car_count, now)
                 
                 # Debug logging for high traffic
                 if raw_car_count >= HIGH_TRAFFIC_THRESHOLD or car_count >= HIGH_TRAFFIC_THRESHOLD:
-                    logger.info(f"⚠️  Raw: {raw_car_count} cars, Confirmed: {car_count} cars, High Traffic Mode: {self.is_high_traffic_mode}")
+                    logger.info("⚠️  Raw: %d cars, Confirmed: %d cars, High Traffic Mode: %s",
+                                raw_car_count, car_count, self.is_high_traffic_mode)
                 
                 # Save training data if enabled (use raw count for actual detections)
-                self.save_training_frame(frame, raw_car_count)
+                self.save_training_frame(frame, raw_car_count, now)
                 
                 # Update traffic light logic (use confirmed count)
-                self.update_traffic_lights(car_count)
-                
-                # Get rendered frame with detections
-                display_frame = results.render()[0].copy()
+                self.update_traffic_lights(car_count, now)
                 
-                # Optional: Draw custom smaller labels if you want even more control
-                # Uncomment the next line and comment the above line for custom rendering
-                # display_frame = self.draw_custom_detections(frame.copy(), results.pandas().xyxy[0])
-                
-                # Draw interface (show both raw and confirmed counts)
-                self.draw_interface(display_frame, raw_car_count, car_count)
-                
-                # Show frame
-                cv2.imshow('Dual Traffic Light AI System', display_frame)
+                if self.headless:
+                    # Nobody is watching - skip rendering entirely, read keys from the console
+                    self.handle_key(self.read_console_key())
+                else:
+                    # Drawing and the window run on the display thread
+                    self.put_latest(self.display_q, (frame, detections, raw_car_count, car_count, now, self.hud_snapshot()))
                 
-                # Handle keyboard input
-                key = cv2.waitKey(1) & 0xFF
-                if key == ord('q'):
+                if self.quit_event.is_set():
                     logger.info("Quit requested by user")
                     break
-                elif key == ord('r'):
+                elif self.reset_event.is_set():
+                    self.reset_event.clear()
                     # Reset to normal mode (no cars detected)
                     self.light_a = 'R'
                     self.light_b = 'G'
@@ -674,15 +1515,129 @@ class DualTrafficLightAI:
         finally:
             self.cleanup()
     
+    def read_window_key(self):
+        """Key press from the video window (waitKey(1) sleeps ~15 ms on Windows, so mostly use pollKey there)"""
+        if sys.platform != 'win32' or not hasattr(cv2, 'pollKey'):
+            return cv2.waitKey(1) & 0xFF
+        
+        self.key_poll_counter += 1
+        if self.key_poll_counter >= KEY_WAIT_INTERVAL:
+            self.key_poll_counter = 0
+            return cv2.waitKey(1) & 0xFF
+        return cv2.pollKey() & 0xFF
+    
+    def read_console_key(self):
+        """Non-blocking key read from the console for headless mode ('q' / 'r' followed by Enter on Linux)"""
+        if not self.console_keys:
+            return -1
+        try:
+            if sys.platform == 'win32':
+                import msvcrt
+                if msvcrt.kbhit():
+                    return ord(msvcrt.getwch().lower())
+                return -1
+            
+            ready, _, _ = select.select([sys.stdin], [], [], 0)
+            if not ready:
+                return -1
+            line = sys.stdin.readline()
+            if not line:
+                # stdin closed - stop polling it
+                self.console_keys = False
+                return -1
+            line = line.strip().lower()
+            return ord(line[0]) if line else -1
+        except (OSError, ValueError):
+            # No usable console (e.g. running as a service)
+            self.console_keys = False
+            return -1
+    
     def cleanup(self):
         """Clean up resources"""
+        self.stop_pipeline()
         if self.cap:
             self.cap.release()
-        cv2.destroyAllWindows()
+        self.stop_serial_writer()
+        self.stop_save_writer()
         if self.arduino:
+            try:
+                self.arduino.flush()  # Drain commands still in the OS buffer before closing
+            except Exception as e:
+                logger.error(f"Failed to flush serial port: {e}")
             self.arduino.close()
         logger.info("Cleanup complete")
 
+def build_transitions():
+    """
+    Build the traffic light state machine as a lookup table.
+    Maps (LightState, car count bucket) to the action to run; timers are checked inside the actions.
+    """
+    ai = DualTrafficLightAI
+    table = {}
+    for a, b, mode, ytrans, bucket in product('RYG', 'RYG', (False, True), (False, True),
+                                              (COUNT_NONE, COUNT_LOW, COUNT_HIGH)):
+        if ytrans:
+            # Handle yellow light transition
+            if mode:
+                action = ai.finish_yellow_high_traffic
+            elif bucket == COUNT_HIGH:
+                action = ai.finish_yellow_enter_high_traffic
+            elif bucket == COUNT_NONE:
+                action = ai.finish_yellow_cross_traffic
+            else:
+                action = ai.finish_yellow_ai_control
+        elif bucket == COUNT_HIGH:
+            # Handle high traffic mode (>=8 cars)
+            if mode:
+                action = ai.alternate_high_traffic
+            elif a == 'G':
+                action = ai.start_high_traffic_yellow
+            elif a == 'R' and b != 'G':
+                action = ai.activate_high_traffic
+            elif a == 'R':
+                action = ai.alert_high_traffic
+            else:
+                action = ai.hold_lights
+        elif mode:
+            # Was in high traffic mode, only exit when car count reaches 0
+            action = ai.exit_high_traffic if bucket == COUNT_NONE else ai.continue_high_traffic
+        elif bucket == COUNT_NONE:
+            # No cars detected - give cross traffic the green
+            if a == 'G':
+                action = ai.start_yellow_to_cross
+            elif a == 'R' and b != 'G':
+                action = ai.give_cross_green
+            else:
+                action = ai.hold_lights
+        else:
+            # Any cars detected (1-7) - give AI side the green
+            if a == 'R' and b == 'G':
+                action = ai.start_yellow_to_ai
+            elif a == 'R' or (a == 'G' and b != 'R'):
+                action = ai.give_ai_green
+            else:
+                action = ai.hold_lights
+        table[(LightState(a, b, mode, ytrans), bucket)] = action
+    return table
+
+TRANSITIONS = build_transitions()
+
+def configure_cpu():
+    """Limit library thread pools and pin the process to CPU_AFFINITY so the hot loop doesn't bounce between cores"""
+    if OPENCV_THREADS is not None:
+        cv2.setNumThreads(OPENCV_THREADS)
+    if TORCH_THREADS is not None:
+        torch.set_num_threads(TORCH_THREADS)
+    if CPU_AFFINITY:
+        if hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(0, CPU_AFFINITY)
+                logger.info(f"Pinned to CPU cores {sorted(CPU_AFFINITY)}")
+            except OSError as e:
+                logger.warning(f"Could not set CPU affinity {CPU_AFFINITY}: {e}")
+        else:
+            logger.warning("CPU_AFFINITY is only supported on Linux")
+
 # === [MAIN EXECUTION] ===
 if __name__ == "__main__":
     print("=== Dual Traffic Light AI System ===")
@@ -699,6 +1654,8 @@ if __name__ == "__main__":
     print() 
     
     try:
+        configure_cpu()
+        
         # Create and run the system
         traffic_system = DualTrafficLightAI(MODEL_PATH, COM_PORT, BAUD_RATE)
         traffic_system.run(SOURCE)